@@ -1,22 +1,25 @@
 #!/usr/bin/env python3
 
+import csv
 import logging
 import pysam
 import sys
 import time
 from argparse import ArgumentParser
-from Bio import pairwise2
+from collections import Counter
+from dataclasses import dataclass
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
-from functools import partial
 from gzip import open as gzopen
 from itertools import islice
 from multiprocessing import Pool
-from numpy import cumsum
+from numpy import fromiter, int64
 from pathlib import Path
+from queue import Full, Queue
 from re import match as re_match
+from threading import Thread
 
 logging.basicConfig(level=logging.INFO, datefmt='%H:%M:%S', format="[%(asctime)s] %(levelname)s - %(message)s")
-_linkers = ["TAGCCATCGCATTGC", "TACCTCTGAGCTGAA"]
+_linkers = [b"TAGCCATCGCATTGC", b"TACCTCTGAGCTGAA"]
 _barcodes = ["AAAGAA", "AACAGC", "AACGTG", "AAGCCA", "AAGTAT", "AATTGG",
         "ACAAGG", "ACCCAA", "ACCTTC", "ACGGAC", "ACTGCA", "AGACCC", "AGATGT",
         "AGCACG", "AGGTTA", "AGTAAA", "AGTCTG", "ATACTT", "ATAGCG", "ATATAC",
@@ -31,41 +34,158 @@ _barcodes = ["AAAGAA", "AACAGC", "AACGTG", "AAGCCA", "AAGTAT", "AATTGG",
         "TATTTC", "TCAGTG", "TCATCA", "TCCAAG", "TCGCCT", "TCGGGA", "TCTAGC",
         "TGAATT", "TGAGAC", "TGCGGT", "TGCTAA", "TGGCAG", "TGTGTA", "TGTTCG",
         "TTAAGA", "TTCGCA", "TTCTTG", "TTGCTC", "TTGGAT", "TTTGGG"]
+_errors = ["LX", "L1", "L2", "I", "D", "J", "K", "B"]
+_low_bits = [int.from_bytes(b"\x01" * n, "big") for n in range(33)] # lowest bit of each byte
 
-_local_aligner = partial(pairwise2.align.localxs, one_alignment_only=True)
-_global_aligner = partial(pairwise2.align.globalxs, score_only=True, one_alignment_only=True)
+_batch_size = 8192 # number of reads sent to a worker at once
 
-_cell_count={}
-_error_count = {}
+_cell_count = Counter()
+_error_count = Counter()
 
 def hamming_dist(s1, s2):
-    """Return the Hamming distance between equal-length sequences
+    """Return the Hamming distance between equal-length byte sequences
 
-    >>> hamming_distance("ACG", "ACT")
+    >>> hamming_dist(b"ACG", b"ACT")
     1
     """
-    if (len(s1) != len(s2)):
+    n = len(s1)
+    if (n != len(s2)):
         raise ValueError("Undefined for sequences of unequal length")
-    return sum(el1 != el2 for el1, el2 in zip(s1, s2))
+    # xor the sequences as integers and fold every byte into its lowest bit
+    x = int.from_bytes(s1, "big") ^ int.from_bytes(s2, "big")
+    x |= x >> 4
+    x |= x >> 2
+    x |= x >> 1
+    mask = _low_bits[n] if n < len(_low_bits) else int.from_bytes(b"\x01" * n, "big")
+    return bin(x & mask).count("1")
+
+def find_linker(sequence, linker, first=0, last=None):
+    """Search linker starting between positions first and last (default: whole
+    sequence) allowing 1 edit distance. Exact matches are preferred, then 1
+    mismatch, then 1 indel. Return a tuple (begin, k) where k is 0 for 0-1
+    mismatch, -1 for 1 deletion and 1 for 1 insertion, or (-1, 0) if the
+    linker is not found.
+
+    >>> find_linker(b"AAAAAATAGCCATCGCATTGCAAAAAA", b"TAGCCATCGCATTGC")
+    (6, 0)
+
+    >>> find_linker(b"CTAAAAAATAGCCATCGCATTGCAAAAAA", b"TAGCCATCGCATTGC")
+    (8, 0)
+
+    >>> find_linker(b"CTAAAAAATAGCCATCGAATTGCAAAAAA", b"TAGCCATCGCATTGC")
+    (8, 0)
+
+    >>> find_linker(b"AAAAATAGCCATCCATTGCAAAAAA", b"TAGCCATCGCATTGC")
+    (5, -1)
+
+    >>> find_linker(b"AAAAATAGCCATCGGCATTGCAAAAAA", b"TAGCCATCGCATTGC")
+    (5, 1)
+
+    >>> find_linker(b"AAAAAATAGCCATCGCATTGCAAAAAA", b"TAGCCATCGCATTGC", 0, 4)
+    (-1, 0)
+    """
+    n = len(linker)
+    first = max(first, 0)
+    if last is None:
+        last = len(sequence)
+    # most common case: exact match
+    begin = sequence.find(linker, first, last+n)
+    if begin >= 0:
+        return(begin, 0)
+    starts = range(first, last+1)
+    for begin in starts:
+        segment = sequence[begin: begin+n]
+        if len(segment) == n and hamming_dist(segment, linker) <= 1:
+            return(begin, 0)
+    for begin in starts:
+        if is_single_indel(sequence[begin: begin+n-1], linker):
+            return(begin, -1)
+        # an extra base in first position is a shifted linker, not an insertion
+        segment = sequence[begin: begin+n+1]
+        if segment[:1] == linker[:1] and is_single_indel(linker, segment):
+            return(begin, 1)
+    return(-1, 0)
+
+def is_single_indel(short, long):
+    """Return True if short is obtained removing exactly one base from long
+
+    >>> is_single_indel(b"ACT", b"ACGT")
+    True
+    """
+    if len(long) != len(short) + 1:
+        return(False)
+    i = 0
+    while i < len(short) and short[i] == long[i]:
+        i += 1
+    return(short[i:] == long[i+1:])
+
+def make_barcode_lookup(barcodes):
+    """Map every sequence within 1 edit distance (mismatch, indel) of a
+    barcode to the barcode itself. Keys are bytes to match the encoded reads.
+    Raise ValueError if a sequence is within 1 edit distance of two barcodes,
+    since it could not be assigned unambiguously.
+
+    >>> make_barcode_lookup(["ACGTAC", "CGTACG"])
+    Traceback (most recent call last):
+    ...
+    ValueError: Barcodes ACGTAC and CGTACG are both within 1 edit distance of ACGTACG
+    """
+    lookup = {}
+    for bc in barcodes:
+        neighbors = {bc}
+        for i in range(len(bc)):
+            neighbors.add(bc[:i] + bc[i+1:]) # deletion
+            for nt in "ACGTN":
+                neighbors.add(bc[:i] + nt + bc[i+1:]) # mismatch
+        for i in range(len(bc)+1):
+            for nt in "ACGTN":
+                neighbors.add(bc[:i] + nt + bc[i:]) # insertion
+        for block in sorted(neighbors):
+            if lookup.setdefault(block, bc) != bc:
+                raise ValueError("Barcodes {} and {} are both within 1 edit distance of {}".format(
+                    lookup[block], bc, block))
+    return({block.encode(): bc for block, bc in lookup.items()})
+
+_bc_lookup = make_barcode_lookup(_barcodes)
 
 def fix_block(block):
-    """Set barcode to most similar (up to 1 mismatch)
+    """Set barcode to most similar (up to 1 mismatch or indel)
+
+    >>> fix_block(b"TTTGGG")
+    'TTTGGG'
 
-    >>> fix_block("TTTGGG")
+    >>> fix_block(b"TTTGAG")
     'TTTGGG'
 
-    >>> fix_block("TTTGAG")
+    >>> fix_block(b"TTTGG")
     'TTTGGG'
 
-    >>> fix_block("TTTGAA")
-    ''
+    >>> fix_block(b"TTTAGGG")
+    'TTTGGG'
+
+    >>> fix_block(b"TTTTTT")
     """
-    for bc in _barcodes:
-        score = _global_aligner(bc, block, -1, -1)
-        if len(block) >= 5 and score >= 5:
-            return(bc)
-    else:
-        return(None)
+    return(_bc_lookup.get(block))
+
+@dataclass(frozen=True)
+class TagNames:
+    """SAM tags used for cell barcode, UMI (and their base qualities) and errors"""
+    bc: str
+    bc_q: str
+    umi: str
+    umi_q: str
+    error: str
+
+def init_worker(tag_names):
+    """Set the tag names used by get_tags in the current process"""
+    global _tag_bc, _tag_bc_q, _tag_umi, _tag_umi_q, _tag_error, _error_tags
+    _tag_bc    = tag_names.bc
+    _tag_bc_q  = tag_names.bc_q
+    _tag_umi   = tag_names.umi
+    _tag_umi_q = tag_names.umi_q
+    _tag_error = tag_names.error
+    # tags returned for failed reads are built once and shared
+    _error_tags = {error: {_tag_error: error} for error in _errors}
 
 def get_tags(record):
     """Extract barcodes from R1 and return a tuple of SAM-format TAGs.
@@ -84,44 +204,26 @@ def get_tags(record):
     K = indel in UMI or GAC trinucleotide
     B = one BC with more than 1 mismatch"""
 
-    sequence = record[1].upper()
+    sequence = record[1].upper().encode()
     quality = record[2]
-    linker_start_index = []
-    k = []
     # find the start of the 2 linker sequences, allowing 1 edit distance (mismatch, indel)
-    for linker in _linkers:
-        try:
-            alignment = _local_aligner(sequence, linker, -2, -1)[0]
-        except IndexError:
-            linker_start_index.append(None)
-            continue
-        seqA, seqB, score, begin, end = alignment
-        length = end - begin
-        if length == 15 and score >= 14:
-            # 0-1 mismatch
-            linker_start_index.append(begin)
-            k.append(0)
-        elif length == 14 and score == 14:
-            # 1 mismatch at starting position
-            linker_start_index.append(begin - 1)
-            k.append(0)
-        elif "-" in seqA[begin:end] and length == 15 and score == 12:
-            # 1 deletion
-            linker_start_index.append(begin)
-            k.append(-1)
-        elif "-" in seqB and length == 16 and score == 13:
-            # 1 insertion
-            linker_start_index.append(begin)
-            k.append(1)
-        else:
-            linker_start_index.append(None)
-
-    if linker_start_index[0] is None and linker_start_index[1] is None:
-        return(dict([(_tag_error, "LX")])) # no linker aligned
-    elif linker_start_index[0] is None:
-        return(dict([(_tag_error, "L1")])) # linker 1 not aligned
-    elif linker_start_index[1] is None:
-        return(dict([(_tag_error, "L2")])) # linker 2 not aligned
+    start1, k1 = find_linker(sequence, _linkers[0])
+    start2 = -1
+    if start1 >= 0:
+        # linker 2 is expected 21 bases after linker 1 (+/- 1 indel in BC2)
+        expected = start1 + 21 + k1
+        start2, k2 = find_linker(sequence, _linkers[1], expected-2, expected+2)
+    if start2 < 0:
+        start2, k2 = find_linker(sequence, _linkers[1])
+    linker_start_index = [start1, start2]
+    k = [k1, k2]
+
+    if linker_start_index[0] < 0 and linker_start_index[1] < 0:
+        return(_error_tags["LX"]) # no linker aligned
+    elif linker_start_index[0] < 0:
+        return(_error_tags["L1"]) # linker 1 not aligned
+    elif linker_start_index[1] < 0:
+        return(_error_tags["L2"]) # linker 2 not aligned
 
     # extract block 2 if the distance between the linker blocks is equal to 21 (+/- 1 indel)
     if linker_start_index[1]-linker_start_index[0] == 21+k[0]:
@@ -129,16 +231,16 @@ def get_tags(record):
         bc2_q = quality[linker_start_index[1]-6: linker_start_index[1]]
     elif linker_start_index[1]-linker_start_index[0] == 20+k[0]: # 1 deletion in bc2
         bc2 = sequence[linker_start_index[1]-5: linker_start_index[1]]
-        bc2_q = sequence[linker_start_index[1]-5: linker_start_index[1]]
+        bc2_q = quality[linker_start_index[1]-5: linker_start_index[1]]
     elif linker_start_index[1]-linker_start_index[0] == 22+k[0]: # 1 insertion in bc2
         bc2 = sequence[linker_start_index[1]-7: linker_start_index[1]]
         bc2_q = quality[linker_start_index[1]-7: linker_start_index[1]]
     else:
-        return(dict([(_tag_error, "I")]))
+        return(_error_tags["I"])
 
     # extract block 1 if the length of block 1 is greater than or equal to 5 bases
     if linker_start_index[0] < 5:
-        return(dict([(_tag_error, "D")]))
+        return(_error_tags["D"])
     elif linker_start_index[0] == 5:
         bc1 = sequence[: linker_start_index[0]]
         bc1_q = quality[: linker_start_index[0]]
@@ -148,30 +250,21 @@ def get_tags(record):
 
     # extract ACG block and check the sequence
     acg = sequence[linker_start_index[1]+21+k[1]: linker_start_index[1]+24+k[1]]
-    i = 0
-    thr = 0
-    while i < len(acg) and thr <= 1:
-        if acg[i] != "ACG"[i]:
-            thr += 1
-        i += 1
-    else:
-        if thr > 1:
-            return(dict([(_tag_error, "J")]))
     try:
-        dist_acg = hamming_dist(acg, "ACG")
+        dist_acg = hamming_dist(acg, b"ACG")
     except ValueError:
         dist_acg = float("inf")
     if dist_acg > 1:
-        return(dict([(_tag_error, "J")]))
+        return(_error_tags["J"])
 
     # extract GAC block and check the sequence
     gac = sequence[linker_start_index[1]+32+k[1]: linker_start_index[1]+35+k[1]]
     try:
-        dist_gac = hamming_dist(gac, "GAC")
+        dist_gac = hamming_dist(gac, b"GAC")
     except ValueError:
         dist_gac = float("inf")
     if dist_gac > 1:
-        return(dict([(_tag_error, "K")]))
+        return(_error_tags["K"])
 
     # extract block 3
     bc3 = sequence[linker_start_index[1]+15+k[1]: linker_start_index[1]+21+k[1]]
@@ -184,101 +277,158 @@ def get_tags(record):
         if fixed:
             barcode.append(fixed)
         else:
-            return(dict([(_tag_error, "B")]))
+            return(_error_tags["B"])
     barcode = "".join(barcode)
     barcode_q = "".join([bc1_q, bc2_q, bc3_q])
 
     # extract Unique Molecula Identifier (UMI)
-    umi = sequence[linker_start_index[1]+24+k[1]: linker_start_index[1]+32+k[1]]
+    umi = sequence[linker_start_index[1]+24+k[1]: linker_start_index[1]+32+k[1]].decode()
     umi_q = quality[linker_start_index[1]+24+k[1]: linker_start_index[1]+32+k[1]]
 
     #  print(dict([(_tag_bc, barcode), (_tag_umi, umi), (_tag_umi_q, umi_q), (_tag_bc_q, barcode_q)]))
     return(dict([(_tag_bc, barcode), (_tag_umi, umi), (_tag_umi_q, umi_q), (_tag_bc_q, barcode_q)]))
 
-def compute_summary(tags):
-    # summary statistics
-    if tags.get(_tag_error):
-        _error_count[tags[_tag_error]] = _error_count.get(tags[_tag_error], 0) + 1
-    elif tags.get(_tag_bc):
-        _cell_count[tags[_tag_bc]] = _cell_count.get(tags[_tag_bc], 0) + 1
-        _error_count["PASS"] = _error_count.get("PASS", 0) + 1
+def get_tags_batch(records):
+    """Return the list of tags of a batch of R1 records"""
+    return([get_tags(record) for record in records])
+
+def batched(iterable, n):
+    """Yield lists of n consecutive items (the last one may be shorter)"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+def write_reads(queue, in_reads2, out_file, pipeline, errors):
+    """Write R2 records tagged with the batches of tags taken from queue
+    until None is received. An exception stops the writer and is appended to
+    errors"""
+    i = 0
+    # a single unmapped record is reused for every R2 read
+    sam_record = pysam.AlignedSegment()
+    sam_record.flag = 4
+    # bind names used for every read to locals
+    dropseq = pipeline == "dropseq"
+    write = out_file.write
+    to_array = pysam.qualitystring_to_array
+    tag_bc, tag_umi = _tag_bc, _tag_umi
+    try:
+        for tags_batch in iter(queue.get, None):
+            # R1 tags and R2 records are consumed in lock-step in a single pass
+            for tags in tags_batch:
+                record = next(in_reads2, None)
+                if record is None:
+                    raise ValueError("R2 file has fewer reads than R1 file")
+                title, seq, qual = record
+                i += 1
+                if i % 1000000 == 0:
+                    logging.info("{} reads processed.".format(str(i)))
+                if dropseq:
+                    sam_record.query_name = title.split()[0]
+                    sam_record.query_sequence = seq
+                    sam_record.query_qualities = to_array(qual)
+                    sam_record.template_length = len(seq)
+                    sam_record.set_tags(tags.items())
+                    write(sam_record)
+                elif tag_bc in tags:
+                    write("@{}_{}#{}\n{}\n+\n{}\n".format(tags[tag_bc], tags[tag_umi], title.split()[0], seq, qual))
+    except Exception as error:
+        # passed to the main thread, which raises it after join()
+        errors.append(error)
+        return
+    logging.info("{} reads processed.".format(str(i)))
+
+def put_while_alive(queue, item, thread):
+    """Put item on queue while thread (the consumer) is running. Return False
+    if thread stopped before the item could be queued"""
+    while thread.is_alive():
+        try:
+            queue.put(item, timeout=1)
+            return(True)
+        except Full:
+            continue
+    return(False)
+
+def compute_summary(tags_batch):
+    # summary statistics (counted by Counter in C, one batch at a time)
+    cell_count = Counter(tags[_tag_bc] for tags in tags_batch if _tag_bc in tags)
+    _error_count.update(tags[_tag_error] for tags in tags_batch if _tag_error in tags)
+    _error_count["PASS"] += sum(cell_count.values())
+    _cell_count.update(cell_count)
 
 def write_summary(summary_path):
     file_name = summary_path + ".errors.csv"
-    ordered_tags = ["LX", "L1", "L2", "I", "D", "J", "K", "B", "PASS"]
-    out = open(file_name, "w")
-    out.write("Error\tCount\tFraction\n")
-    for tag in ordered_tags:
-        count = _error_count.get(tag, 0)
-        fraction = _error_count.get(tag, 0)/sum(_error_count.values())
-        out.write("{}\t{}\t{}\n".format(tag, count, fraction))
-    out.close()
+    ordered_tags = _errors + ["PASS"]
+    total = sum(_error_count.values())
+    with open(file_name, "w", newline="") as out:
+        writer = csv.writer(out, delimiter="\t", lineterminator="\n")
+        writer.writerow(["Error", "Count", "Fraction"])
+        writer.writerows((tag, _error_count.get(tag, 0), _error_count.get(tag, 0)/total)
+            for tag in ordered_tags)
 
     file_name = summary_path + ".cell_barcodes.csv"
     sorted_barcodes = sorted(_cell_count, key=lambda x: _cell_count[x], reverse=True)
-    cell_cumsum = cumsum([_cell_count[b] for b in sorted_barcodes])/sum(_cell_count.values())
-    out = open(file_name, "w")
-    out.write("Cell_Barcode\tCount\tCumulative_Sum\n")
-    for i, barcode in enumerate(sorted_barcodes):
-        out.write("{}\t{}\t{}\n".format(barcode, _cell_count[barcode],
-            cell_cumsum[i]))
-    out.close()
+    counts = fromiter((_cell_count[b] for b in sorted_barcodes), dtype=int64,
+            count=len(sorted_barcodes))
+    cell_cumsum = counts.cumsum()/counts.sum()
+    with open(file_name, "w", newline="") as out:
+        writer = csv.writer(out, delimiter="\t", lineterminator="\n")
+        writer.writerow(["Cell_Barcode", "Count", "Cumulative_Sum"])
+        writer.writerows(zip(sorted_barcodes, counts.tolist(), cell_cumsum.tolist()))
 
 def main():
     args = parse_args()
 
-    global _tag_bc
-    global _tag_bc_q
-    global _tag_umi
-    global _tag_umi_q
-    global _tag_error
-    _tag_bc    = args.tag_bc
-    _tag_bc_q  = args.tag_bc_q
-    _tag_umi   = args.tag_umi
-    _tag_umi_q = args.tag_umi_q
-    _tag_error = args.tag_error
+    tag_names = TagNames(args.tag_bc, args.tag_bc_q, args.tag_umi, args.tag_umi_q,
+            args.tag_error)
+    init_worker(tag_names)
 
     bam_write_mode = "w" if args.output == "-" else "wb"
     in_filename1, in_filename2 = args.input
 
     # Processing ####
     _start = time.perf_counter()
-    in_reads1 = (record for record in FastqGeneralIterator(gzopen(in_filename1, "rt")))
-    in_reads2 = (record for record in FastqGeneralIterator(gzopen(in_filename2, "rt")))
+    in_reads1 = FastqGeneralIterator(gzopen(in_filename1, "rt"))
+    in_reads2 = FastqGeneralIterator(gzopen(in_filename2, "rt"))
 
     if args.subset: # DEBUGGING PURPOSES
         in_reads1 = islice(in_reads1, args.subset)
 
     if args.pipeline == "dropseq":
         bam_header = {'HD':{'VN': '1.6', 'SO':'unknown'}}
-        out_bam = pysam.AlignmentFile(args.output, bam_write_mode, header=bam_header)
+        # let htslib compress BGZF blocks with additional threads
+        out_bam = pysam.AlignmentFile(args.output, bam_write_mode, header=bam_header,
+                threads=max(1, args.cores//2))
 
     elif args.pipeline == "scpipe":
         out_fastq = gzopen(args.output, "wt")
 
     logging.info("Extracting tags.")
-    pool = Pool(args.cores)
-
-    for (i, tags) in enumerate(pool.imap(get_tags, in_reads1), 1):
-        if (i) % 1e6 == 0:
-            logging.info("{} reads processed.".format(str(i)))
-        if args.pipeline == "dropseq":
-            title, seq, qual = next(in_reads2)
-            sam_record = pysam.AlignedSegment()
-            sam_record.query_name = title.split()[0]
-            sam_record.query_sequence = seq
-            sam_record.query_qualities = pysam.qualitystring_to_array(qual)
-            sam_record.template_length = len(seq)
-            sam_record.flag = 4
-            sam_record.set_tags(tags.items())
-            out_bam.write(sam_record)
-        elif args.pipeline == "scpipe" and tags.get(_tag_bc):
-            title, seq, qual = next(in_reads2)
-            out_fastq.write("@{}_{}#{}\n{}\n+\n{}\n".format(tags[_tag_bc], tags[_tag_umi], title.split()[0], seq, qual))
-
+    # workers receive the tag names explicitly instead of inheriting them via fork
+    pool = Pool(args.cores, initializer=init_worker, initargs=(tag_names,))
+
+    # R2 records are written by a separate thread while tags are computed
+    queue = Queue(maxsize=64)
+    out_file = out_bam if args.pipeline == "dropseq" else out_fastq
+    write_errors = []
+    # daemon thread: an error in the workers must not leave it waiting on the queue
+    writer = Thread(target=write_reads,
+            args=(queue, in_reads2, out_file, args.pipeline, write_errors), daemon=True)
+    writer.start()
+
+    # send reads to the workers in batches to limit inter-process communication
+    for tags_batch in pool.imap(get_tags_batch, batched(in_reads1, _batch_size)):
+        if not put_while_alive(queue, tags_batch, writer):
+            break # the writer stopped on an error
         if args.summary_prefix: # summary statistics
-            compute_summary(tags)
-    logging.info("{} reads processed.".format(str(i)))
+            compute_summary(tags_batch)
+    put_while_alive(queue, None, writer)
+    writer.join()
+    if write_errors:
+        pool.terminate()
+        raise write_errors[0]
     pool.close()
     logging.info("All reads analyzed.")
 